@@ -1,17 +1,63 @@
 import sqlite3
 import json
+import queue
+import threading
+from dataclasses import dataclass
+
+try:
+    # C-implemented JSON codec, noticeably faster on large conversation
+    # payloads. Optional: everything falls back to the stdlib module.
+    # fsm_definition stays on stdlib json either way for stable diffs.
+    import orjson
+except ImportError:
+    orjson = None
+
 from FSM import FSMManager
 STATE_NUM = 4
 ACTIONS_NUM = 5
 TRANSITION_NUM = 20
 
+# FSM definitions are immutable once seeded, so parsed definitions and the
+# system prompts formatted from them are cached per process and shared by
+# every DatabaseManager instance.
+_fsm_def_cache = {}
+_system_prompt_cache = {}
+
+@dataclass(slots=True)
+class RunState:
+    """In-memory state of one model's run on a single FSM instance."""
+    run_id: int
+    instance_id: int
+    model_name: str
+    conversation_history: list
+    current_turn: int
+    ground_truth_state: str  # set at creation; no consumer updates it per turn anymore
+    last_llm_state: str
+    is_task_correct: bool
+    is_complete: bool
+    fsm_def: dict
+    saved_messages: int  # how many conversation messages are already persisted
+
 class DatabaseManager:
     """Handles all SQLite database operations for the multi-model FSM experiment."""
 
     def __init__(self, db_name="fsm_experiment.db"):
         self.db_name = db_name
         self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        # Name-based row access; rows still support positional indexing.
+        self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
+        # Tune the connection for concurrent workers: WAL lets readers run
+        # alongside the writer and turns each commit into a cheap log append
+        # instead of a full journal fsync. Note: WAL keeps '-wal'/'-shm'
+        # sidecar files next to the .db file.
+        self.cursor.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA busy_timeout=5000;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-65536;
+        """)
         self._create_tables()
 
     def _create_tables(self):
@@ -27,7 +73,7 @@ class DatabaseManager:
                 run_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 instance_id INTEGER NOT NULL,
                 model_name TEXT NOT NULL,
-                conversation_history TEXT NOT NULL,
+                conversation_history TEXT DEFAULT '',
                 current_turn INTEGER DEFAULT 0,
                 ground_truth_state TEXT NOT NULL,
                 last_llm_state TEXT NOT NULL,
@@ -36,6 +82,20 @@ class DatabaseManager:
                 UNIQUE(instance_id, model_name)
             )
         """)
+        # Append-only conversation log. Messages are written once as they
+        # are produced instead of re-serializing the whole history JSON on
+        # every turn (which grew O(turns^2) in total bytes written). The
+        # legacy conversation_history column is kept only so that old
+        # databases can be migrated on first load.
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_messages (
+                run_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (run_id, seq)
+            )
+        """)
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS results (
                 result_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,6 +119,13 @@ class DatabaseManager:
                 failure_type TEXT
             )
         """)
+        # Covering indices for the hot lookups: run state is always fetched
+        # by (model_name, instance_id), pending runs by (model_name,
+        # is_complete), and the aggregate rebuild probes error_log by
+        # (model_name, instance_id, turn_number).
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_model_inst ON experiment_runs(model_name, instance_id)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_model_complete ON experiment_runs(model_name, is_complete)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_errors_model_inst_turn ON error_log(model_name, instance_id, turn_number)")
         self.conn.commit()
 
     def _get_max_existing_instance_id(self):
@@ -73,8 +140,13 @@ class DatabaseManager:
         excess data and recalculates aggregates for the specified model.
         """
         max_existing_id = self._get_max_existing_instance_id()
-        
-        # If new target is >= existing, it's an increase or no-op. Nothing to do.
+
+        # If new target is >= existing, it's an increase or no-op. Nothing to
+        # do. This guard matches the purge predicate below: the DELETEs use
+        # 'instance_id > new_total_instances', which only removes rows when
+        # new_total_instances < max_existing_id — exactly the case that
+        # falls through here. When the two are equal the deletes would be
+        # no-ops and the rebuild pure waste, so returning is correct.
         if new_total_instances >= max_existing_id:
             return
 
@@ -83,63 +155,55 @@ class DatabaseManager:
         print(f"INFO: Purging all data for instances > {new_total_instances}...")
         
         try:
-            # Step 1: Purge all excess data
+            # Step 1: Purge all excess data (and any cached definitions,
+            # since the purged instance_ids may be reseeded later)
+            _fsm_def_cache.clear()
+            _system_prompt_cache.clear()
             self.cursor.execute("DELETE FROM fsm_definitions WHERE instance_id > ?", (new_total_instances,))
+            self.cursor.execute("""
+                DELETE FROM conversation_messages WHERE run_id IN (
+                    SELECT run_id FROM experiment_runs WHERE instance_id > ?
+                )
+            """, (new_total_instances,))
             self.cursor.execute("DELETE FROM experiment_runs WHERE instance_id > ?", (new_total_instances,))
             self.cursor.execute("DELETE FROM error_log WHERE instance_id > ?", (new_total_instances,))
-            
+
             # Step 2: Wipe the aggregate results for *this model*
             print(f"INFO: Wiping old aggregates for model: '{model_name}'")
             self.cursor.execute("DELETE FROM results WHERE model_name = ?", (model_name,))
-            self.conn.commit()
 
-            # Step 3: Rebuild the aggregate results from the remaining data
+            # Step 3: Rebuild the aggregate results from the remaining data.
+            # A turn counts as a turn success when no error was logged at
+            # exactly that turn, and as a task success when no error was
+            # logged at that turn or any earlier one (including priming
+            # failures at turn 0). Done entirely in SQL: one row per turn,
+            # grouped over every surviving run that reached that turn.
             print(f"INFO: Rebuilding aggregates for '{model_name}' from remaining {new_total_instances} instances...")
-            
-            # Get all remaining runs and errors for this model
-            self.cursor.execute("SELECT instance_id, current_turn FROM experiment_runs WHERE model_name = ? AND instance_id <= ?", (model_name, new_total_instances))
-            all_runs = self.cursor.fetchall() # (instance_id, max_turn)
-            
-            self.cursor.execute("SELECT instance_id, turn_number FROM error_log WHERE model_name = ? AND instance_id <= ?", (model_name, new_total_instances))
-            all_errors = self.cursor.fetchall() # (instance_id, turn_number)
-
-            errors_by_instance = {}
-            for inst_id, turn_num in all_errors:
-                if inst_id not in errors_by_instance:
-                    errors_by_instance[inst_id] = set()
-                errors_by_instance[inst_id].add(turn_num)
-
-            for turn in range(1, total_turns + 1):
-                task_length = turn * steps_per_turn
-                
-                total_runs_for_this_len = 0
-                turn_successes_for_this_len = 0
-                task_successes_for_this_len = 0
-
-                for inst_id, max_turn in all_runs:
-                    if max_turn < turn:
-                        continue
-                    
-                    total_runs_for_this_len += 1
-                    instance_errors = errors_by_instance.get(inst_id, set())
-                    
-                    if turn not in instance_errors:
-                        turn_successes_for_this_len += 1
-                    
-                    task_failed = False
-                    for error_turn in instance_errors:
-                        if error_turn <= turn:
-                            task_failed = True
-                            break
-                    if not task_failed:
-                        task_successes_for_this_len += 1
-                
-                if total_runs_for_this_len > 0:
-                    self.cursor.execute(
-                        "INSERT INTO results (model_name, task_length, turn_successes, task_successes, total_runs) VALUES (?, ?, ?, ?, ?)",
-                        (model_name, task_length, turn_successes_for_this_len, task_successes_for_this_len, total_runs_for_this_len)
+            self.cursor.execute("""
+                INSERT INTO results (model_name, task_length, turn_successes, task_successes, total_runs)
+                SELECT ?, t.turn * ?,
+                       SUM(CASE WHEN NOT EXISTS (
+                               SELECT 1 FROM error_log e
+                               WHERE e.model_name = ? AND e.instance_id = r.instance_id
+                                 AND e.turn_number = t.turn
+                           ) THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN NOT EXISTS (
+                               SELECT 1 FROM error_log e
+                               WHERE e.model_name = ? AND e.instance_id = r.instance_id
+                                 AND e.turn_number <= t.turn
+                           ) THEN 1 ELSE 0 END),
+                       COUNT(*)
+                FROM experiment_runs r
+                JOIN (
+                    WITH RECURSIVE turns(turn) AS (
+                        SELECT 1 UNION ALL SELECT turn + 1 FROM turns WHERE turn < ?
                     )
-            
+                    SELECT turn FROM turns
+                ) t ON r.current_turn >= t.turn
+                WHERE r.model_name = ? AND r.instance_id <= ?
+                GROUP BY t.turn
+            """, (model_name, steps_per_turn, model_name, model_name, total_turns, model_name, new_total_instances))
+
             self.conn.commit()
             print("INFO: Aggregate rebuild complete. Proceeding with experiment.")
             print("-----------------------------------------")
@@ -160,6 +224,7 @@ class DatabaseManager:
         new_definitions_to_create = total_instances - count
         print(f"Found {count} FSM definitions. Generating {new_definitions_to_create} new ones to reach a total of {total_instances}...")
         
+        rows = []
         for i in range(count + 1, total_instances + 1):
             fsm = FSMManager()
             fsm.create_random_fsm(num_states=STATE_NUM, num_actions=ACTIONS_NUM, num_transitions=TRANSITION_NUM)
@@ -169,13 +234,47 @@ class DatabaseManager:
                 "transitions": fsm.transitions,
                 "initial_state": fsm.initial_state
             }
-            self.cursor.execute(
+            rows.append((i, json.dumps(definition)))
+
+        # One prepared statement and one transaction for the whole batch.
+        with self.conn:
+            self.cursor.executemany(
                 "INSERT OR IGNORE INTO fsm_definitions (instance_id, fsm_definition) VALUES (?, ?)",
-                (i, json.dumps(definition))
+                rows
             )
-        self.conn.commit()
         print("FSM definitions saved successfully.")
 
+    def get_fsm_definition(self, instance_id):
+        """Returns the parsed FSM definition for an instance, caching it for the process lifetime."""
+        fsm_def = _fsm_def_cache.get(instance_id)
+        if fsm_def is None:
+            self.cursor.execute("SELECT fsm_definition FROM fsm_definitions WHERE instance_id = ?", (instance_id,))
+            def_row = self.cursor.fetchone()
+            if not def_row:
+                raise Exception(f"FATAL: FSM Definition for instance {instance_id} not found.")
+            fsm_def = _fsm_def_cache[instance_id] = json.loads(def_row[0])
+        return fsm_def
+
+    def preload_fsm_definitions(self):
+        """
+        Loads every stored FSM definition into the process-wide cache with a
+        single query, so workers starting afterwards never have to touch
+        fsm_definitions individually.
+        """
+        self.cursor.execute("SELECT instance_id, fsm_definition FROM fsm_definitions")
+        for row in self.cursor.fetchall():
+            _fsm_def_cache.setdefault(row[0], json.loads(row[1]))
+
+    def get_system_prompt(self, instance_id):
+        """Returns the prompt-formatted FSM for an instance, formatting it at most once per process."""
+        prompt = _system_prompt_cache.get(instance_id)
+        if prompt is None:
+            fsm_def = self.get_fsm_definition(instance_id)
+            fsm = FSMManager() # Use a temporary FSM object to format the prompt
+            fsm.states, fsm.actions, fsm.transitions, fsm.initial_state = set(fsm_def["states"]), set(fsm_def["actions"]), fsm_def["transitions"], fsm_def["initial_state"]
+            prompt = _system_prompt_cache[instance_id] = fsm.get_prompt_formatted_fsm()
+        return prompt
+
     def get_or_create_run_state(self, instance_id, model_name, supports_system_prompt: bool):
         """
         Retrieves the state of a specific model's run on an FSM instance.
@@ -187,79 +286,107 @@ class DatabaseManager:
         )
         row = self.cursor.fetchone()
 
+        fsm_def = self.get_fsm_definition(instance_id)
+
         if row:
             # Run exists, load its state
-            return {
-                "run_id": row[0], "instance_id": row[1], "model_name": row[2],
-                "conversation_history": json.loads(row[3]), "current_turn": row[4],
-                "ground_truth_state": row[5], "last_llm_state": row[6],
-                "is_task_correct": bool(row[7]), "is_complete": bool(row[8])
-            }
+            run_id = row["run_id"]
+            self.cursor.execute(
+                "SELECT role, content FROM conversation_messages WHERE run_id = ? ORDER BY seq",
+                (run_id,)
+            )
+            conversation = [{"role": r["role"], "content": r["content"]} for r in self.cursor.fetchall()]
+            if not conversation and row["conversation_history"]:
+                # Legacy database: history still lives in the JSON column.
+                # Backfill the message log once so future turns only append.
+                conversation = orjson.loads(row["conversation_history"]) if orjson else json.loads(row["conversation_history"])
+                self._append_messages(run_id, 0, conversation)
+                self.conn.commit()
+            return RunState(
+                run_id=run_id, instance_id=row["instance_id"], model_name=row["model_name"],
+                conversation_history=conversation, current_turn=row["current_turn"],
+                ground_truth_state=row["ground_truth_state"], last_llm_state=row["last_llm_state"],
+                is_task_correct=bool(row["is_task_correct"]), is_complete=bool(row["is_complete"]),
+                fsm_def=fsm_def, saved_messages=len(conversation)
+            )
         else:
             # Run does not exist, create a new one
-            self.cursor.execute("SELECT fsm_definition FROM fsm_definitions WHERE instance_id = ?", (instance_id,))
-            def_row = self.cursor.fetchone()
-            if not def_row:
-                raise Exception(f"FATAL: FSM Definition for instance {instance_id} not found.")
+            system_prompt = self.get_system_prompt(instance_id)
 
-            fsm_def = json.loads(def_row[0])
-            fsm = FSMManager() # Use a temporary FSM object to format the prompt
-            fsm.states, fsm.actions, fsm.transitions, fsm.initial_state = set(fsm_def["states"]), set(fsm_def["actions"]), fsm_def["transitions"], fsm_def["initial_state"]
-            system_prompt = fsm.get_prompt_formatted_fsm()
-            
             if supports_system_prompt:
                 initial_conversation = [{"role": "system", "content": system_prompt}]
             else:
                 # For other models, the "system prompt" is the first user message
                 initial_conversation = [{"role": "user", "content": system_prompt}]
 
-            initial_state = {
-                "instance_id": instance_id, "model_name": model_name,
-                "conversation_history": initial_conversation,
-                "current_turn": 0, "ground_truth_state": fsm_def["initial_state"],
-                "last_llm_state": fsm_def["initial_state"], "is_task_correct": True,
-                "is_complete": False
-            }
-
+            # conversation_history is written explicitly: pre-migration
+            # databases declare the column NOT NULL without a default, and
+            # CREATE TABLE IF NOT EXISTS does not relax that.
             self.cursor.execute("""
                 INSERT INTO experiment_runs (instance_id, model_name, conversation_history, ground_truth_state, last_llm_state)
-                VALUES (?, ?, ?, ?, ?)
+                VALUES (?, ?, '', ?, ?)
             """, (
-                instance_id, model_name, json.dumps(initial_state["conversation_history"]),
-                initial_state["ground_truth_state"], initial_state["last_llm_state"]
+                instance_id, model_name,
+                fsm_def["initial_state"], fsm_def["initial_state"]
             ))
+            run_id = self.cursor.lastrowid
+            self._append_messages(run_id, 0, initial_conversation)
             self.conn.commit()
-            return initial_state
+            return RunState(
+                run_id=run_id, instance_id=instance_id, model_name=model_name,
+                conversation_history=initial_conversation, current_turn=0,
+                ground_truth_state=fsm_def["initial_state"],
+                last_llm_state=fsm_def["initial_state"],
+                is_task_correct=True, is_complete=False,
+                fsm_def=fsm_def, saved_messages=len(initial_conversation)
+            )
+
+    def _append_messages(self, run_id, start_seq, messages):
+        """Appends messages to the conversation log starting at start_seq. Does not commit."""
+        self.append_messages(run_id, start_seq, [(m["role"], m["content"]) for m in messages])
+
+    def append_messages(self, run_id, start_seq, rows):
+        """
+        Appends (role, content) rows to the conversation log starting at
+        start_seq. Takes plain tuples rather than a live RunState so the
+        call can be queued on a StorageWorker as an immutable snapshot.
+        Does not commit.
+        """
+        self.cursor.executemany(
+            "INSERT OR IGNORE INTO conversation_messages (run_id, seq, role, content) VALUES (?, ?, ?, ?)",
+            [(run_id, start_seq + i, role, content) for i, (role, content) in enumerate(rows)]
+        )
 
-    def update_run_state(self, state):
-        """Saves the updated state of an experiment run after a turn."""
+    def update_run_cursor(self, run_id, current_turn, last_llm_state, is_task_correct, is_complete):
+        """
+        Saves a run's scalar progress fields. Paired with append_messages
+        this replaces rewriting any part of the conversation: a turn's
+        write cost is one small UPDATE plus one row per new message,
+        independent of how long the history has grown. Does not commit.
+        """
         self.cursor.execute("""
             UPDATE experiment_runs
-            SET conversation_history = ?, current_turn = ?, ground_truth_state = ?,
-                last_llm_state = ?, is_task_correct = ?, is_complete = ?
-            WHERE instance_id = ? AND model_name = ?
-        """, (
-            json.dumps(state["conversation_history"]), state["current_turn"],
-            state["ground_truth_state"], state["last_llm_state"],
-            int(state["is_task_correct"]), int(state["is_complete"]),
-            state["instance_id"], state["model_name"]
-        ))
-        self.conn.commit()
+            SET current_turn = ?, last_llm_state = ?,
+                is_task_correct = ?, is_complete = ?
+            WHERE run_id = ?
+        """, (current_turn, last_llm_state, int(is_task_correct), int(is_complete), run_id))
 
     def update_results(self, model_name, task_length, turn_was_correct, task_is_correct):
-        """Updates the aggregated results table for a specific model."""
+        """Updates the aggregated results table for a specific model. Does not commit."""
         self.cursor.execute(
             "INSERT INTO results (model_name, task_length, turn_successes, task_successes, total_runs) VALUES (?, ?, ?, ?, 1) ON CONFLICT(model_name, task_length) DO UPDATE SET turn_successes = turn_successes + excluded.turn_successes, task_successes = task_successes + excluded.task_successes, total_runs = total_runs + 1",
             (model_name, task_length, int(turn_was_correct), int(task_is_correct))
         )
-        self.conn.commit()
 
     def log_error(self, model_name, instance_id, turn, length, expected, actual, failure_type):
-        """Logs the details of a failed turn to the error_log table for a specific model."""
+        """Logs the details of a failed turn to the error_log table for a specific model. Does not commit."""
         self.cursor.execute("""
             INSERT INTO error_log (model_name, instance_id, turn_number, task_length, expected_state, llm_raw_response, failure_type)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         """, (model_name, instance_id, turn, length, expected, actual, failure_type))
+
+    def commit(self):
+        """Commits any pending writes from the transaction-agnostic helpers above."""
         self.conn.commit()
 
     def prepare_runs_for_extension(self, model_name, new_total_turns):
@@ -278,14 +405,21 @@ class DatabaseManager:
             print(f"INFO: Marked {updated_rows} previously completed runs for model '{model_name}' to be extended.")
 
     def get_runs_to_process(self, total_instances, model_name):
-        """Gets a list of instance_ids that are not yet complete for the given model."""
+        """
+        Gets a list of instance_ids that are not yet complete for the given
+        model. Deliberately a set difference against the ids with
+        is_complete = 1 rather than a WHERE is_complete = 0 query: instances
+        that have no experiment_runs row yet must also be returned, and runs
+        that prepare_runs_for_extension just reset to is_complete = 0 fall
+        out of the completed set and are picked up again.
+        """
         self.cursor.execute(
             "SELECT instance_id FROM experiment_runs WHERE model_name = ? AND is_complete = 1",
             (model_name,)
         )
         completed_ids = {row[0] for row in self.cursor.fetchall()}
         all_ids = set(range(1, total_instances + 1))
-        return sorted(list(all_ids - completed_ids))
+        return sorted(all_ids - completed_ids)
 
     def get_all_results(self):
         """Retrieves all data from the results table for plotting."""
@@ -293,4 +427,73 @@ class DatabaseManager:
         return self.cursor.fetchall()
         
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        # Refresh the query-planner statistics for the indices above before
+        # the connection goes away.
+        self.cursor.execute("PRAGMA optimize")
+        self.conn.close()
+
+
+class StorageWorker(threading.Thread):
+    """
+    Single background writer that owns its own database connection. Work
+    items are (method_name, args) pairs naming one of DatabaseManager's
+    transaction-agnostic write helpers; the worker drains the queue in
+    batches and commits once per batch, so submitters never wait on an
+    fsync. Arguments must be immutable snapshots, since they are applied
+    on the worker thread after the caller has moved on.
+    """
+
+    def __init__(self, db_name="fsm_experiment.db", batch_size=256):
+        super().__init__(name="storage-worker", daemon=True)
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.first_error = None
+        self.dropped_writes = 0
+
+    def submit(self, method, *args):
+        """Queues a write; returns immediately."""
+        self.queue.put((method, args))
+
+    def run(self):
+        db = DatabaseManager(self.db_name)
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for method, args in batch:
+                    if method is None:
+                        stopping = True
+                        continue
+                    # One failed write (e.g. "database is locked" past the
+                    # busy_timeout) must not kill the thread and silently
+                    # drop everything queued after it; keep draining and
+                    # surface the first failure from close().
+                    try:
+                        getattr(db, method)(*args)
+                    except Exception as e:
+                        if self.first_error is None:
+                            self.first_error = e
+                        self.dropped_writes += 1
+                        print(f"ERROR: storage worker failed to apply {method}{args}: {e}")
+                db.commit()
+        finally:
+            db.close()
+
+    def close(self):
+        """
+        Flushes every queued write, then stops the thread. Raises the first
+        write failure (if any) so callers report data loss instead of
+        success.
+        """
+        self.queue.put((None, ()))
+        self.join()
+        if self.first_error is not None:
+            raise RuntimeError(
+                f"storage worker dropped {self.dropped_writes} write(s); first failure below"
+            ) from self.first_error
\ No newline at end of file
@@ -1,12 +1,13 @@
 import re
 import time
-import random
 import json
-import concurrent.futures
-from openai import OpenAI
-from tqdm import tqdm
-from FSM import FSMManager
-from database_manager import DatabaseManager
+import random
+import atexit
+import asyncio
+import threading
+from openai import AsyncOpenAI, RateLimitError
+from tqdm.asyncio import tqdm
+from database_manager import DatabaseManager, StorageWorker
 
 # --- Experiment Configuration ---
 #MODEL_NAME = "qwen3-235b-a22b-instruct-2507" 
@@ -20,150 +21,357 @@ TOTAL_INSTANCES = 10
 TURNS_PER_INSTANCE = 6
 STEPS_PER_TURN = 5
 MAX_WORKERS = 5
-# Number of parallel threads
-SLEEP_TIME = 0
+# Maximum number of in-flight API requests
+MAX_RETRIES = 6
+# Retries per request on rate-limit errors, with exponential backoff
+BACKOFF_CAP = 30
+# Upper bound (seconds) on a single backoff sleep
+MAX_REQUESTS_PER_MINUTE = 300
+MAX_TOKENS_PER_MINUTE = 150_000
+# Local request/token budgets; set these to the account's actual limits
+EXPECTED_COMPLETION_TOKENS = 1024
+# Rough completion-size reserve used when estimating a request's cost
 USE_STREAMING = True # Set to True to use streaming API calls
+THINKING_MIN_TURN = 3
+# First turn that gets enable_thinking; priming and shorter-history turns
+# are deterministic state-following and don't need the reasoning tokens
 
 RUN_IDENTIFIER = f"{MODEL_NAME} (Steps: {STEPS_PER_TURN})"
 # ---
 
+# One DatabaseManager per worker thread, reused across all instances that
+# thread processes, instead of a fresh connection per instance.
+_tls = threading.local()
+_open_dbs = []
+_open_dbs_lock = threading.Lock()
+
+def _get_db() -> DatabaseManager:
+    """Returns this thread's DatabaseManager, opening it on first use."""
+    db = getattr(_tls, "db", None)
+    if db is None:
+        db = _tls.db = DatabaseManager()
+        with _open_dbs_lock:
+            _open_dbs.append(db)
+    return db
+
+@atexit.register
+def _close_open_dbs():
+    with _open_dbs_lock:
+        for db in _open_dbs:
+            db.close()
+        _open_dbs.clear()
+
+# Compiled once; DOTALL also tolerates newlines inside the tag.
+_STATE_RE = re.compile(r"<state>(.*?)</state>", re.IGNORECASE | re.DOTALL)
+
 def decode_response(response: str) -> str | None:
     """Extracts the state name from the <state> tags."""
     if not response: return None
-    match = re.search(r"<state>(.*?)</state>", response, re.IGNORECASE)
+    match = _STATE_RE.search(response)
     return match.group(1).strip() if match else None
 
-def simulate_turn(fsm_manager, start_state, num_steps):
-    """Deterministically simulates a sequence of steps to get actions and expected final state."""
-    sequence, current_state = [], start_state
-    for i in range(num_steps):
+def build_transition_table(fsm_def):
+    """
+    Lowers an FSM definition into int-indexed dense tables so the simulator
+    works on small integers instead of string-keyed dicts. Returns
+    (state_to_idx, state_names, action_names, next_state, available) where
+    next_state[s][a] is the target state index (-1 if the action is not
+    defined in state s) and available[s] is the tuple of defined action
+    indices for state s.
+    """
+    state_names = sorted(fsm_def["states"])
+    action_names = sorted(fsm_def["actions"])
+    state_to_idx = {s: i for i, s in enumerate(state_names)}
+    action_to_idx = {a: i for i, a in enumerate(action_names)}
+    next_state = [[-1] * len(action_names) for _ in state_names]
+    for from_state, actions in fsm_def["transitions"].items():
+        row = next_state[state_to_idx[from_state]]
+        for action, to_state in actions.items():
+            row[action_to_idx[action]] = state_to_idx[to_state]
+    available = [tuple(a for a, t in enumerate(row) if t >= 0) for row in next_state]
+    return state_to_idx, state_names, action_names, next_state, available
+
+def simulate_turn(table, start_state, num_steps, _choice=random.choice):
+    """
+    Simulates a sequence of steps to get actions and expected final state.
+    Walks the dense int tables from build_transition_table; names are only
+    translated at the boundaries. A start state unknown to the FSM (e.g. a
+    hallucinated LLM answer) yields an empty sequence, as before.
+    """
+    state_to_idx, state_names, action_names, next_state, available = table
+    s_idx = state_to_idx.get(start_state)
+    if s_idx is None:
+        return "", start_state
+    chosen = []
+    for _ in range(num_steps):
         # Gracefully handle states with no outgoing transitions
-        if not current_state or not fsm_manager.transitions.get(current_state):
+        actions = available[s_idx]
+        if not actions:
             break
-        available_actions = list(fsm_manager.transitions.get(current_state, {}).keys())
-        if not available_actions: break
-        action = random.choice(available_actions)
-        sequence.append(action)
-        current_state = fsm_manager.transitions[current_state][action]
-    return ", ".join(sequence), current_state
-
-def get_model_response(client, messages, model_name, use_streaming):
+        a = _choice(actions)
+        chosen.append(a)
+        s_idx = next_state[s_idx][a]
+    return ", ".join(action_names[a] for a in chosen), state_names[s_idx]
+
+class RateLimiter:
+    """
+    Proactive token-bucket limiter over requests-per-minute and
+    tokens-per-minute. Requests are paced locally before being sent, so
+    raising MAX_WORKERS converts into steady throughput at the configured
+    budget instead of 429 storms followed by backoff.
+    """
+    def __init__(self, max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+                 max_tokens_per_minute=MAX_TOKENS_PER_MINUTE):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = float(max_requests_per_minute)
+        self.available_token_capacity = float(max_tokens_per_minute)
+        self.last_update_time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.last_update_time = now
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + elapsed * self.max_requests_per_minute / 60.0
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + elapsed * self.max_tokens_per_minute / 60.0
+        )
+
+    async def acquire(self, est_tokens):
+        """Sleeps until both buckets can pay for one request of est_tokens."""
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= est_tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= est_tokens
+                return
+            wait = max(
+                (1 - self.available_request_capacity) * 60.0 / self.max_requests_per_minute,
+                (est_tokens - self.available_token_capacity) * 60.0 / self.max_tokens_per_minute
+            )
+            await asyncio.sleep(max(wait, 0.01))
+
+_rate_limiter = RateLimiter()
+
+def _estimate_tokens(messages):
+    """Crude request-cost estimate: ~4 chars per prompt token plus a completion reserve."""
+    return len(json.dumps(messages)) // 4 + EXPECTED_COMPLETION_TOKENS
+
+async def get_model_response(client, messages, model_name, use_streaming, sem, think=True):
     """
     Handles both streaming and non-streaming API calls and returns the full response content.
-    Uses the fixed parameters from the experiment.
+    Uses the fixed parameters from the experiment. The semaphore caps the
+    number of in-flight API requests at MAX_WORKERS; rate-limit responses
+    are retried with capped exponential backoff and jitter, so no time is
+    spent sleeping unless the provider actually pushes back. think controls
+    enable_thinking on the streaming path.
     """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await _request_model_response(client, messages, model_name, use_streaming, sem, think)
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(min(BACKOFF_CAP, 2 ** attempt) + random.random())
+
+async def _request_model_response(client, messages, model_name, use_streaming, sem, think):
+    """Issues a single API request (no retry handling)."""
     raw_response = ""
-    try:
+    await _rate_limiter.acquire(_estimate_tokens(messages))
+    async with sem:
         if use_streaming:
-            stream = client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 messages=messages,
                 model=model_name,
                 temperature=0.0,
-                extra_body={"enable_thinking": True},
+                extra_body={"enable_thinking": think},
                 stream=True
             )
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    raw_response += chunk.choices[0].delta.content
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    raw_response += delta
+                    # Everything after the closing tag is thrown away by
+                    # decode_response, so stop reading (and free the HTTP
+                    # connection) as soon as a complete answer has arrived.
+                    # Only the tail can contain a tag finished by this delta.
+                    if "</state>" in raw_response[-(len(delta) + 8):] and _STATE_RE.search(raw_response):
+                        await stream.close()
+                        break
         else:
-            completion = client.chat.completions.create(
+            completion = await client.chat.completions.create(
                 messages=messages,
                 model=model_name,
                 temperature=0.0,
                 extra_body={"enable_thinking": False},
-                stream=False 
+                stream=False
             )
             raw_response = completion.choices[0].message.content
-    except Exception as e:
-        raise e
-    
+
     return raw_response
 
-def process_run(instance_id: int):
-    """Processes all turns for a single FSM instance for the configured RUN_IDENTIFIER."""
-    db = DatabaseManager()
-    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-    fsm = FSMManager()
-    
+async def prime_run(instance_id: int, client, sem, storage):
+    """
+    Runs the priming exchange for one instance if it still needs one.
+    Priming depends only on the system prompt — not on other turns or
+    instances — so batch_prime can dispatch every pending instance's
+    priming request at once before the turn-by-turn loops start.
+    Returns an error string on failure, None otherwise.
+    """
+    db = _get_db()
     state = db.get_or_create_run_state(instance_id, RUN_IDENTIFIER, SUPPORTS_SYSTEM_PROMPT)
-    
-    fsm_def_cursor = db.cursor.execute("SELECT fsm_definition FROM fsm_definitions WHERE instance_id = ?", (instance_id,))
-    fsm_def = json.loads(fsm_def_cursor.fetchone()[0])
-    fsm.states, fsm.actions, fsm.transitions, fsm.initial_state = set(fsm_def["states"]), set(fsm_def["actions"]), fsm_def["transitions"], fsm_def["initial_state"]
+    if SUPPORTS_SYSTEM_PROMPT or len(state.conversation_history) != 1:
+        return None
 
-    if not SUPPORTS_SYSTEM_PROMPT and len(state["conversation_history"]) == 1:
-        try:
-            raw_response = get_model_response(
-                client, 
-                messages=state["conversation_history"], 
-                model_name=MODEL_NAME, 
-                use_streaming=USE_STREAMING
-            )
-            llm_initial_state = decode_response(raw_response)
+    initial_state = state.fsm_def["initial_state"]
+    try:
+        raw_response = await get_model_response(
+            client,
+            messages=state.conversation_history,
+            model_name=MODEL_NAME,
+            use_streaming=USE_STREAMING,
+            sem=sem,
+            think=False  # priming is a single echo of the initial state
+        )
+        llm_initial_state = decode_response(raw_response)
 
-            state["conversation_history"].append({"role": "assistant", "content": raw_response})
-            
-            if llm_initial_state != fsm.initial_state:
-                print(f"WARNING: Instance {instance_id} failed priming. Expected '{fsm.initial_state}', got '{llm_initial_state}'.")
-                db.log_error(RUN_IDENTIFIER, instance_id, 0, 0, f"<state>{fsm.initial_state}</state>", raw_response, "initialization_failed")
-                state["is_task_correct"] = False
+        # Keep only the canonical answer in the resent history; any thinking
+        # tail would otherwise be re-sent as prompt tokens on every later
+        # turn. Undecodable replies are kept raw for inspection.
+        if llm_initial_state is not None:
+            state.conversation_history.append({"role": "assistant", "content": f"<state>{llm_initial_state}</state>"})
+        else:
+            state.conversation_history.append({"role": "assistant", "content": raw_response})
 
-            state["last_llm_state"] = llm_initial_state if llm_initial_state is not None else fsm.initial_state
-            
-            db.update_run_state(state)
+        if llm_initial_state != initial_state:
+            print(f"WARNING: Instance {instance_id} failed priming. Expected '{initial_state}', got '{llm_initial_state}'.")
+            storage.submit("log_error", RUN_IDENTIFIER, instance_id, 0, 0, f"<state>{initial_state}</state>", raw_response, "initialization_failed")
+            state.is_task_correct = False
 
-        except Exception as e:
-            db.close()
-            print(e)
-            return f"ERROR during PRIMING on Instance {instance_id} ({RUN_IDENTIFIER}): {e}"
-    
-    while state["current_turn"] < TURNS_PER_INSTANCE:
-        time.sleep(SLEEP_TIME)
-        state["current_turn"] += 1
-        task_length = state["current_turn"] * STEPS_PER_TURN
+        state.last_llm_state = llm_initial_state if llm_initial_state is not None else initial_state
+
+        # Priming must be durable before process_run reloads the run state,
+        # so this one write stays synchronous instead of going through the
+        # storage worker.
+        unsaved = state.conversation_history[state.saved_messages:]
+        db.append_messages(state.run_id, state.saved_messages, [(m["role"], m["content"]) for m in unsaved])
+        state.saved_messages += len(unsaved)
+        db.update_run_cursor(state.run_id, state.current_turn, state.last_llm_state, state.is_task_correct, state.is_complete)
+        db.commit()
+
+    except Exception as e:
+        print(e)
+        return f"ERROR during PRIMING on Instance {instance_id} ({RUN_IDENTIFIER}): {e}"
+    return None
+
+def _checkpoint(storage, state):
+    """
+    Queues a run's checkpoint on the storage worker: the scalar cursor
+    fields plus only the messages appended since the last checkpoint.
+    Snapshots are taken here, on the event-loop thread, so the worker
+    never reads the live RunState.
+    """
+    unsaved = state.conversation_history[state.saved_messages:]
+    if unsaved:
+        storage.submit(
+            "append_messages", state.run_id, state.saved_messages,
+            tuple((m["role"], m["content"]) for m in unsaved)
+        )
+        state.saved_messages += len(unsaved)
+    storage.submit(
+        "update_run_cursor", state.run_id, state.current_turn,
+        state.last_llm_state, state.is_task_correct, state.is_complete
+    )
+
+async def batch_prime(client, sem, storage, instance_ids):
+    """Dispatches all pending priming requests concurrently."""
+    await asyncio.gather(*(prime_run(i, client, sem, storage) for i in instance_ids))
+
+async def process_run(instance_id: int, client, sem, storage):
+    """Processes all turns for a single FSM instance for the configured RUN_IDENTIFIER."""
+    # No-op when the instance is already primed (or uses a system prompt).
+    priming_error = await prime_run(instance_id, client, sem, storage)
+    if priming_error:
+        return priming_error
+
+    db = _get_db()
+    state = db.get_or_create_run_state(instance_id, RUN_IDENTIFIER, SUPPORTS_SYSTEM_PROMPT)
+
+    fsm_def = state.fsm_def
+    # Transitions are immutable for the life of the run; lower them to
+    # int-indexed dense tables once per instance.
+    table = build_transition_table(fsm_def)
+
+    while state.current_turn < TURNS_PER_INSTANCE:
+        state.current_turn += 1
+        task_length = state.current_turn * STEPS_PER_TURN
         
-        action_seq, expected_state_from_llm = simulate_turn(fsm, state["last_llm_state"], STEPS_PER_TURN)
+        action_seq, expected_state_from_llm = simulate_turn(table, state.last_llm_state, STEPS_PER_TURN)
 
-        state["conversation_history"].append({"role": "user", "content": action_seq})
+        state.conversation_history.append({"role": "user", "content": action_seq})
         try:
-            raw_response = get_model_response(
-                client, 
-                messages=state["conversation_history"], 
-                model_name=MODEL_NAME, 
-                use_streaming=USE_STREAMING
+            raw_response = await get_model_response(
+                client,
+                messages=state.conversation_history,
+                model_name=MODEL_NAME,
+                use_streaming=USE_STREAMING,
+                sem=sem,
+                think=state.current_turn >= THINKING_MIN_TURN
             )
             llm_state = decode_response(raw_response)
-            state["conversation_history"].append({"role": "assistant", "content": raw_response})
+            # As in priming: store the canonical <state> answer, not the
+            # full response, so prompt size grows by a few tokens per turn
+            # instead of by the whole thinking tail.
+            if llm_state is not None:
+                state.conversation_history.append({"role": "assistant", "content": f"<state>{llm_state}</state>"})
+            else:
+                state.conversation_history.append({"role": "assistant", "content": raw_response})
         except Exception as e:
-            db.close()
             print(e)
-            return f"ERROR on Instance {instance_id} ({RUN_IDENTIFIER}), Turn {state['current_turn']}: {e}"
+            return f"ERROR on Instance {instance_id} ({RUN_IDENTIFIER}), Turn {state.current_turn}: {e}"
 
         turn_correct = (llm_state is not None) and (llm_state == expected_state_from_llm)
-        
+
         if not turn_correct:
             failure_type = "decode_error" if llm_state is None else "state_mismatch"
             # Log error with RUN_IDENTIFIER
-            db.log_error(RUN_IDENTIFIER, instance_id, state["current_turn"], task_length, f"<state>{expected_state_from_llm}</state>", raw_response, failure_type)
+            storage.submit("log_error", RUN_IDENTIFIER, instance_id, state.current_turn, task_length, f"<state>{expected_state_from_llm}</state>", raw_response, failure_type)
+
+        if state.is_task_correct and not turn_correct:
+            state.is_task_correct = False
 
-        if state["is_task_correct"] and not turn_correct:
-            state["is_task_correct"] = False
-        
-        state["ground_truth_state"] = expected_state_from_llm
-        
         if llm_state is not None:
-            state["last_llm_state"] = llm_state
-        
-        db.update_results(RUN_IDENTIFIER, task_length, turn_correct, state["is_task_correct"])
-        db.update_run_state(state) 
+            state.last_llm_state = llm_state
 
-    state["is_complete"] = True
-    db.update_run_state(state)
-    db.close()
+        storage.submit("update_results", RUN_IDENTIFIER, task_length, turn_correct, state.is_task_correct)
+        _checkpoint(storage, state)
+
+    state.is_complete = True
+    _checkpoint(storage, state)
     return f"Instance {instance_id} ({RUN_IDENTIFIER}) completed."
 
 # --- Main Experiment Logic ---
 
+async def _run_instances(runs_to_process, storage):
+    """Runs all pending instances concurrently on one event loop."""
+    client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL)
+    sem = asyncio.Semaphore(MAX_WORKERS)
+    try:
+        if not SUPPORTS_SYSTEM_PROMPT:
+            # Priming requests are mutually independent; fire them all in
+            # one batch so the turn loops start from primed conversations.
+            await batch_prime(client, sem, storage, runs_to_process)
+        await tqdm.gather(
+            *(process_run(i, client, sem, storage) for i in runs_to_process),
+            desc=f"Processing FSMs for {RUN_IDENTIFIER}"
+        )
+    finally:
+        await client.close()
+
 def run_experiment():
     """Main function to orchestrate the FSM evaluation."""
     if API_KEY == "YOUR_API_KEY":
@@ -180,6 +388,7 @@ def run_experiment():
         steps_per_turn=STEPS_PER_TURN
     )
     db.ensure_fsm_definitions(TOTAL_INSTANCES)
+    db.preload_fsm_definitions()
     db.prepare_runs_for_extension(RUN_IDENTIFIER, TURNS_PER_INSTANCE)
     
     runs_to_process = db.get_runs_to_process(TOTAL_INSTANCES, RUN_IDENTIFIER)
@@ -197,10 +406,14 @@ def run_experiment():
         return
 
     start_time = time.time()
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        list(tqdm(executor.map(process_run, runs_to_process), total=len(runs_to_process), desc=f"Processing FSMs for {RUN_IDENTIFIER}"))
-            
+
+    storage = StorageWorker()
+    storage.start()
+    try:
+        asyncio.run(_run_instances(runs_to_process, storage))
+    finally:
+        storage.close() # flush queued writes before reporting completion
+
     print(f"\n🎉 Experiment for '{RUN_IDENTIFIER}' finished!")
     print(f"Total execution time: {time.time() - start_time:.2f} seconds")
     print("You can now run plot_results.py to generate the graphs.")
@@ -1,7 +1,7 @@
-import sqlite3
+import concurrent.futures
 import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np 
+
+from plot_utils import read_results, apply_academic_style, plot_accuracy, finish_axes
 
 
 EXPERIMENTS_TO_COMPARE = [
@@ -26,6 +26,15 @@ TASK_ACCURACY_PLOT_FILE = "comparison_task_accuracy.png"
 TURN_ACCURACY_PLOT_FILE = "comparison_turn_accuracy.png"
 # --- End Configuration ---
 
+def _load_experiment(label, db_path):
+    """Loads one experiment's results table. Returns (label, db_path, DataFrame or None)."""
+    try:
+        df = read_results(db_path)
+    except Exception as e:
+        print(f"  ❌ Error: Could not read {db_path}. {e}")
+        return label, db_path, None
+    return label, db_path, df
+
 def plot_separate_comparisons(experiments: list):
     """
     Reads results from multiple database files and plots two separate
@@ -36,38 +45,23 @@ def plot_separate_comparisons(experiments: list):
         experiments (list): A list of tuples, where each tuple contains
                             (label_for_plot, database_file_path).
     """
-    
-    # --- Set Matplotlib Style Parameters for a cleaner, academic look ---
-    plt.style.use('seaborn-v0_8-whitegrid') # Starting with a clean grid style
-    plt.rcParams.update({
-        'font.size': 14,
-        'axes.labelsize': 16,
-        'axes.titlesize': 18,
-        'xtick.labelsize': 12,
-        'ytick.labelsize': 12,
-        'legend.fontsize': 12,
-        'lines.linewidth': 2.5,
-        'grid.color': 'lightgray',
-        'grid.linestyle': '--',
-        'grid.linewidth': 0.7,
-        'axes.edgecolor': 'black',
-        'axes.linewidth': 1.0
-    })
-    
+
+    apply_academic_style()
+
     fig_task, ax_task = plt.subplots(figsize=(10, 7))
 
     fig_turn, ax_turn = plt.subplots(figsize=(10, 7))
 
     print(f"--- Aggregating {len(experiments)} Experiment(s) ---")
 
-    for label, db_path in experiments:
-        print(f"\nProcessing: '{label}' (from {db_path})")
-        try:
-            conn = sqlite3.connect(db_path)
-            df = pd.read_sql_query("SELECT * FROM results", conn)
-            conn.close()
-        except Exception as e:
-            print(f"  ❌ Error: Could not read {db_path}. {e}")
+    # SQLite I/O and pandas parsing release the GIL, so the databases load
+    # in parallel; plotting stays sequential in the main thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(experiments))) as executor:
+        loaded = list(executor.map(_load_experiment, *zip(*experiments)))
+
+    for label, db_path, df in loaded:
+        print(f"\nProcessing: '{label}'")
+        if df is None:
             continue
 
         if df.empty:
@@ -77,61 +71,23 @@ def plot_separate_comparisons(experiments: list):
         models_in_db = df['model_name'].unique()
         print(f"  Found {len(models_in_db)} model result(s) in this DB: {', '.join(models_in_db)}")
 
-        for model_name in models_in_db:
-            model_df = df[df['model_name'] == model_name].copy()
-            
-            if model_df.empty:
-                continue
-
-            # Calculate accuracies
-            model_df['task_accuracy'] = model_df['task_successes'] / model_df['total_runs']
-            model_df['turn_accuracy'] = model_df['turn_successes'] / model_df['total_runs']
-            
-           
-            plot_label = f"{label} - {model_name}"
-            
-            # --- Plot on Task Accuracy (Figure 1) ---
-            ax_task.plot(
-                model_df['task_length'], 
-                model_df['task_accuracy'], 
-                linestyle='-', 
-                label=plot_label, 
-            )
-            
-            # --- Plot on Turn Accuracy (Figure 2) ---
-            ax_turn.plot(
-                model_df['task_length'], 
-                model_df['turn_accuracy'], 
-                linestyle='-', 
-                label=plot_label, 
-            )
-
-    ax_task.set_title('Task Accuracy vs. Task Length')
-    ax_task.set_xlabel('Task Length')
-    ax_task.set_ylabel('Task Accuracy')
-    ax_task.set_ylim(-0.05, 1.05)
-    ax_task.set_xlim(left=0) 
-    ax_task.legend()
-    ax_task.grid(True) 
+        plot_accuracy(ax_task, db_path, 'task_accuracy', label_prefix=label)
+        plot_accuracy(ax_turn, db_path, 'turn_accuracy', label_prefix=label)
+
+    finish_axes(ax_task, 'Task Accuracy vs. Task Length', 'Task Accuracy')
     fig_task.tight_layout()
-    
+
     try:
-        fig_task.savefig(TASK_ACCURACY_PLOT_FILE, dpi=300) 
+        fig_task.savefig(TASK_ACCURACY_PLOT_FILE, dpi=300)
         print(f"\n✅ Successfully saved Task Accuracy plot to {TASK_ACCURACY_PLOT_FILE}")
     except Exception as e:
         print(f"\n❌ Error saving Task Accuracy plot: {e}")
 
-    ax_turn.set_title('Turn Accuracy vs. Task Length')
-    ax_turn.set_xlabel('Task Length')
-    ax_turn.set_ylabel('Turn Accuracy')
-    ax_turn.set_ylim(-0.05, 1.05)
-    ax_turn.set_xlim(left=0)
-    ax_turn.legend()
-    ax_turn.grid(True)
+    finish_axes(ax_turn, 'Turn Accuracy vs. Task Length', 'Turn Accuracy')
     fig_turn.tight_layout()
 
     try:
-        fig_turn.savefig(TURN_ACCURACY_PLOT_FILE, dpi=300) 
+        fig_turn.savefig(TURN_ACCURACY_PLOT_FILE, dpi=300)
         print(f"✅ Successfully saved Turn Accuracy plot to {TURN_ACCURACY_PLOT_FILE}")
         plt.show()
     except Exception as e:
@@ -139,4 +95,4 @@ def plot_separate_comparisons(experiments: list):
 
 
 if __name__ == "__main__":
-    plot_separate_comparisons(EXPERIMENTS_TO_COMPARE)
\ No newline at end of file
+    plot_separate_comparisons(EXPERIMENTS_TO_COMPARE)
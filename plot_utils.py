@@ -0,0 +1,96 @@
+import os
+import sqlite3
+from functools import lru_cache
+
+import matplotlib.pyplot as plt
+import pandas as pd
+import numpy as np
+
+MAX_LINE_POINTS = 500
+
+# Accuracies are computed by SQLite so the frame arrives plot-ready.
+RESULTS_QUERY = (
+    "SELECT model_name, task_length, "
+    "CAST(task_successes AS REAL) / total_runs AS task_accuracy, "
+    "CAST(turn_successes AS REAL) / total_runs AS turn_accuracy "
+    "FROM results ORDER BY model_name, task_length"
+)
+
+# Frames and per-model curves are cached keyed on the database's mtime,
+# so the two figures per invocation (and repeated invocations within a
+# session) read and slice each database only once.
+@lru_cache(maxsize=None)
+def _read_results(db_path, mtime):
+    conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query(RESULTS_QUERY, conn)
+    finally:
+        conn.close()
+
+def read_results(db_path):
+    """Reads the plot-ready accuracy frame from one experiment database."""
+    return _read_results(db_path, os.path.getmtime(db_path))
+
+@lru_cache(maxsize=None)
+def _curves(db_path, mtime, model_name):
+    model_df = _read_results(db_path, mtime)
+    model_df = model_df[model_df['model_name'] == model_name]
+    return (
+        model_df['task_length'].to_numpy(),
+        model_df['task_accuracy'].to_numpy(),
+        model_df['turn_accuracy'].to_numpy()
+    )
+
+def model_curves(db_path, model_name):
+    """Returns cached (task_length, task_accuracy, turn_accuracy) arrays for one model."""
+    return _curves(db_path, os.path.getmtime(db_path), model_name)
+
+def apply_academic_style():
+    """Applies the shared clean, academic styling used by all figures."""
+    plt.style.use('seaborn-v0_8-whitegrid')
+    plt.rcParams.update({
+        'font.size': 14,
+        'axes.labelsize': 16,
+        'axes.titlesize': 18,
+        'xtick.labelsize': 12,
+        'ytick.labelsize': 12,
+        'legend.fontsize': 12,
+        'lines.linewidth': 2.5,
+        'grid.color': 'lightgray',
+        'grid.linestyle': '--',
+        'grid.linewidth': 0.7,
+        'axes.edgecolor': 'black',
+        'axes.linewidth': 1.0
+    })
+
+def downsample_line(x, y, max_points=MAX_LINE_POINTS):
+    """
+    Resamples a line onto an evenly spaced x-grid when it has more points
+    than matplotlib can usefully render, keeping figures fast and small.
+    """
+    if len(x) <= max_points:
+        return x, y
+    xg = np.linspace(x.min(), x.max(), max_points)
+    return xg, np.interp(xg, x, y)
+
+def plot_accuracy(ax, db_path, y_col, label_prefix=None):
+    """Plots one accuracy curve per model in the database onto ax."""
+    y_index = 1 if y_col == 'task_accuracy' else 2
+    for model in read_results(db_path)['model_name'].unique():
+        curves = model_curves(db_path, model)
+        label = f"{label_prefix} - {model}" if label_prefix else model
+        ax.plot(
+            *downsample_line(curves[0], curves[y_index]),
+            linestyle='-',
+            label=label
+        )
+
+def finish_axes(ax, title, ylabel):
+    """Applies the common titles, limits, legend and grid to an accuracy axis."""
+    ax.set_title(title)
+    ax.set_xlabel('Task Length')
+    ax.set_ylabel(ylabel)
+    ax.set_ylim(-0.05, 1.05)
+    ax.set_xlim(left=0)
+    ax.legend()
+    ax.grid(True)